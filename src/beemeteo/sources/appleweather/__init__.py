@@ -30,10 +30,10 @@ class AppleWeather(Source):
     def _get_historical_data_source(self, latitude, longitude, gaps, local_tz):
         # Apple Weather will return hourly data in UTC time.
         # https://developer.apple.com/forums/thread/722722
-        df = pd.DataFrame()                                                                                            
+        periods = []
         for ts_ini, ts_end in gaps:
-            data_period = self._request_server(latitude, longitude, "forecastHourly", ts_ini, ts_end, local_tz)
-            df = pd.concat([df, data_period])
+            periods.append(self._request_server(latitude, longitude, "forecastHourly", ts_ini, ts_end, local_tz))
+        df = pd.concat(periods) if periods else pd.DataFrame()
         df.rename(columns={'forecastStart': 'ts'}, inplace=True)
         df = self._to_darksky_format(df, latitude, longitude)
         df['ts']= df['ts'].astype(int).div(10**9).astype(int)
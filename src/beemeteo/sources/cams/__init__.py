@@ -56,7 +56,7 @@ class CAMS(Source):
                 init = False
                 current_gap = [None, None]
 
-        missing_data = pd.DataFrame()
+        periods = []
         for ts_ini, ts_end in new_gaps:
             # for each gap, get the date at instant 0 (we will always download the full day) the ts_end at 00,
             # is also downloaded at full
@@ -64,7 +64,9 @@ class CAMS(Source):
             ts_end = local_tz.localize(datetime.datetime.combine(ts_end.date(), datetime.datetime.max.time()))
             logger.debug("No data for period {ts_ini} {ts_end}, downloading".format(ts_ini=ts_ini, ts_end=ts_end))
             data_period = self._get_historic_period(latitude, longitude, ts_ini, ts_end, local_tz)
-            missing_data = pd.concat([missing_data, data_period])
+            if data_period is not None:
+                periods.append(data_period)
+        missing_data = pd.concat(periods) if periods else pd.DataFrame()
         missing_data = missing_data.sort_values(by=["ts"])
         missing_data['latitude'] = latitude
         missing_data['longitude'] = longitude
@@ -1,7 +1,11 @@
 import datetime
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-from io import StringIO
+from io import BytesIO
 
+import numpy as np
 import pandas as pd
 import xarray as xr
 import pytz
@@ -10,6 +14,14 @@ import requests
 from beemeteo.sources import Source, logger
 from beemeteo.utils import _pandas_dt_to_ts_utc, _pandas_to_tz, _datetime_to_tz, _datetime_dt_to_ts_utc
 
+# maximum number of days downloaded at the same time when filling a gap
+DAILY_DOWNLOAD_WORKERS = 8
+# seconds to wait for the server before giving up a request
+REQUEST_TIMEOUT = 60
+# grid size in km and domain of the model, from the finest to the coarsest
+RESOLUTIONS = [(4, 2), (12, 2), (12, 1), (36, 2), (36, 1)]
+
+
 class MeteoGalicia(Source):
     hbase_table_historical = "meteo_galicia_historical"
     hbase_table_forecasting = "meteo_galicia_forecasting"
@@ -57,14 +69,16 @@ class MeteoGalicia(Source):
         # forecasted_data['latitude'] = (round(forecasted_data['latitude']*precision)).astype(int)/precision
         # forecasted_data['longitude'] = (round(forecasted_data['longitude']*precision)).astype(int)/precision
 
-        forecasted_data['timestamp'] = forecasted_data['timestamp'].astype("datetime64[s]").astype(int)
-        forecasted_data['forecasting_timestamp'] = forecasted_data['forecasting_timestamp'].astype(
-            "datetime64[s]").astype(int)
+        # seconds since epoch from an int64 view of the ns values, no intermediate datetime64[s] copy
+        for ts_col in ['timestamp', 'forecasting_timestamp']:
+            forecasted_data[ts_col] = forecasted_data[ts_col].to_numpy().astype(
+                "datetime64[ns]", copy=False).view("int64") // 10**9
 
         precision = 10
 
-        forecasted_data['latitude'] = (round(forecasted_data['latitude'] * precision)).astype(int) / precision
-        forecasted_data['longitude'] = (round(forecasted_data['longitude'] * precision)).astype(int) / precision
+        # round in a single numpy pass, adding 0.0 turns -0.0 into 0.0 so the cell keys don't depend on the sign
+        for coord in ['latitude', 'longitude']:
+            forecasted_data[coord] = np.round(forecasted_data[coord].to_numpy() * precision) / precision + 0.0
 
         dfs = {}
 
@@ -81,7 +95,7 @@ class MeteoGalicia(Source):
                      'longitude', 'forecasting_timestamp']
         cols_sum = ['u', 'v']
 
-        df_final = pd.DataFrame()
+        results = []
 
         for lat_lon in dfs.keys():
             df = pd.concat(dfs[lat_lon], axis=1)
@@ -91,40 +105,48 @@ class MeteoGalicia(Source):
             result_df = pd.concat([mean_df, sum_df], axis=1)
             result_df['forecasting_timestamp'] = result_df['forecasting_timestamp'].astype(int)
             result_df['timestamp'] = result_df['timestamp'].astype(int)
-            df_final = pd.concat([df_final, result_df])
-        return df_final
+            results.append(result_df)
+        return pd.concat(results) if results else pd.DataFrame()
 
     def _get_historical_data_source(self, latitude, longitude, gaps, local_tz):
-        missing_data = pd.DataFrame()
-        for ts_ini, ts_end in gaps:
-            data_period = pd.DataFrame()
-            # for each gap, get the date at instant 0 (we will always download the full day) the ts_end at 00,
-            # is also downloaded at full
-            ts_ini = local_tz.localize(datetime.datetime.combine(ts_ini.date(), datetime.datetime.min.time()))
-            ts_end = local_tz.localize(datetime.datetime.combine(ts_end.date(), datetime.datetime.min.time()))
-            logger.debug("No data for period {ts_ini} {ts_end}, downloading".format(ts_ini=ts_ini, ts_end=ts_end))
-
-            # meteogalicia starts time of day at 1 UTC. We have to calculate if we need to request for another day.
-            meteogalicia_start = pytz.UTC.localize(datetime.datetime.combine(ts_ini.date(), datetime.time(1))). \
-                astimezone(local_tz)
-            if meteogalicia_start > ts_ini:
-                ts_ini_loop = ts_ini - datetime.timedelta(days=1)
-            else:
-                ts_ini_loop = ts_ini
-
-            for day in pd.date_range(ts_ini_loop, ts_end, freq="1d"):
-                logger.debug("downloading for day {}".format(day))
-                daily_data = self._get_historic_data_day(latitude, longitude, day, local_tz)
-                data_period = pd.concat([data_period, daily_data])
-            data_period = data_period.sort_values(by=["ts"])
-            data_period = data_period.query(
-                "ts >= {} and ts <= {}".format(
-                    ts_ini.timestamp(),
-                    (ts_end + datetime.timedelta(hours=23)).timestamp()
+        periods = []
+        # a single pool bounds the number of requests sent at the same time to the server for all the gaps
+        with ThreadPoolExecutor(max_workers=DAILY_DOWNLOAD_WORKERS) as executor:
+            for ts_ini, ts_end in gaps:
+                # for each gap, get the date at instant 0 (we will always download the full day) the ts_end at 00,
+                # is also downloaded at full
+                ts_ini = local_tz.localize(datetime.datetime.combine(ts_ini.date(), datetime.datetime.min.time()))
+                ts_end = local_tz.localize(datetime.datetime.combine(ts_end.date(), datetime.datetime.min.time()))
+                logger.debug("No data for period {ts_ini} {ts_end}, downloading".format(ts_ini=ts_ini, ts_end=ts_end))
+
+                # meteogalicia starts time of day at 1 UTC. We have to calculate if we need to request for another
+                # day.
+                meteogalicia_start = pytz.UTC.localize(datetime.datetime.combine(ts_ini.date(), datetime.time(1))). \
+                    astimezone(local_tz)
+                if meteogalicia_start > ts_ini:
+                    ts_ini_loop = ts_ini - datetime.timedelta(days=1)
+                else:
+                    ts_ini_loop = ts_ini
+
+                days = list(pd.date_range(ts_ini_loop, ts_end, freq="1d"))
+                logger.debug("downloading {} days".format(len(days)))
+                # each day is an independent request, download them concurrently
+                daily_frames = [
+                    daily_data for daily_data in executor.map(
+                        lambda day: self._get_historic_data_day(latitude, longitude, day, local_tz), days
+                    ) if not daily_data.empty
+                ]
+                data_period = pd.concat(daily_frames) if daily_frames else pd.DataFrame()
+                data_period = data_period.sort_values(by=["ts"])
+                data_period = data_period.query(
+                    "ts >= {} and ts <= {}".format(
+                        ts_ini.timestamp(),
+                        (ts_end + datetime.timedelta(hours=23)).timestamp()
+                    )
                 )
-            )
-            missing_data = pd.concat([missing_data, data_period])
+                periods.append(data_period)
 
+        missing_data = pd.concat(periods) if periods else pd.DataFrame()
         missing_data = missing_data.sort_values(by=["ts"])
         missing_data['latitude'] = latitude
         missing_data['longitude'] = longitude
@@ -144,122 +166,164 @@ class MeteoGalicia(Source):
         :param day: day to retrieve data
         :return: all raw data for a given day
         """
-        run = 0
-        for resolution in [(4, 2), (12, 2), (12, 1), (36, 2), (36, 1)]:
-            try:
-                # Last 14 days of operational forecasts
-                # http://mandeo.meteogalicia.es/
-                # thredds/
-                # ncss/
-                # grid/
-                # wrf_2d_04km/
-                # fmrc/
-                # files/
-                # 20180423/
-                # wrf_arw_det_history_d02_20180423_0000.nc4?
-                # var=swflx&
-                # point=true&
-                # accept=csv&
-                # longitude=0.62&
-                # latitude=41.62&
-                # temporal=all
-                if (
-                        (pytz.UTC.localize(datetime.datetime.utcnow()).astimezone(local_tz) -
-                         day.astimezone(local_tz)).days <= 14
-                ):
-                    url_mg = (
-                        "http://mandeo.meteogalicia.es/"
-                        "thredds/"
-                        "ncss/"
-                        "grid/"
-                        "wrf_2d_%02ikm/"
-                        "fmrc/"
-                        "files/"
-                        "%s/"
-                        "wrf_arw_det_history_d0%s_%s_%02i00.nc4?"
-                        "var=swflx&"
-                        "point=true&"
-                        "accept=csv&"
-                        "longitude=%s&"
-                        "latitude=%s&"
-                        "temporal=all"
-                        % (
-                            resolution[0],
-                            datetime.datetime.strftime(day, "%Y%m%d"),
-                            resolution[1],
-                            datetime.datetime.strftime(day, "%Y%m%d"),
-                            run,
-                            longitude,
-                            latitude,
-                        )
-                    )
-                else:
-                    # Historical forecasts. Only run 00 is available
-                    # http://mandeo.meteogalicia.es/
-                    # thredds/
-                    # ncss/
-                    # grid/
-                    # modelos/
-                    # WRF_HIST/
-                    # d02/
-                    # 2018/
-                    # 01/
-                    # wrf_arw_det_history_d02_20180122_0000.nc4?
-                    # var=swflx&
-                    # point=true&
-                    # accept=csv&
-                    # longitude=41.62&
-                    # latitude=0.62&
-                    # temporal=all
-                    url_mg = (
-                        "http://mandeo.meteogalicia.es/"
-                        "thredds/"
-                        "ncss/"
-                        "grid/"
-                        "modelos/"
-                        "WRF_HIST/"
-                        "d0%s"
-                        "/%s"
-                        "/%s"
-                        "/wrf_arw_det_history_d0%s_%s_0000.nc4?"
-                        "var=swflx&"
-                        "point=true&"
-                        "accept=csv&"
-                        "longitude=%s&"
-                        "latitude=%s&"
-                        "temporal=all"
-                        % (
-                            resolution[1],
-                            datetime.datetime.strftime(day, "%Y"),
-                            datetime.datetime.strftime(day, "%m"),
-                            resolution[1],
-                            datetime.datetime.strftime(day, "%Y%m%d"),
-                            longitude,
-                            latitude,
-                        )
-                    )
-                r = requests.get(url_mg)
-                solar_data = pd.read_csv(StringIO(r.text), sep=",")
-                if len(solar_data) == 0:
-                    raise Exception(
-                        "Location out of the bounding box, "
-                        "trying with another resolution..."
-                        "(Actual: " + str(resolution) + "km)"
-                    )
-                else:
-                    solar_data = solar_data.rename(
-                        columns={"date": "time", 'swflx[unit="W m-2"]': "GHI"}
-                    )
-                    solar_data["ts"] = _pandas_dt_to_ts_utc(
-                        _pandas_to_tz(pd.to_datetime(solar_data["time"]), local_tz)
-                    )
-                    solar_data = solar_data[["ts", "GHI"]]
-                    solar_data = solar_data.reset_index(drop=True)
+        return self._probe_historic_data_day(latitude, longitude, day, local_tz)[1]
 
-                    return solar_data
+    def _probe_historic_data_day(self, latitude, longitude, day, local_tz):
+        """
+        Tries the resolutions from the finest to the coarsest until one of them covers the location. The historical
+        forecasts only depend on the model domain, so the resolutions sharing an url are requested once.
+        The resolutions are probed one after the other on purpose: the days of a gap are already downloaded
+        concurrently and the finest resolution usually covers the location at the first request.
+
+        :param latitude: station's latitude
+        :param longitude: station's longitude
+        :param day: day to retrieve data
+        :param local_tz: the timezone to return the timestamp
+        :return: the resolution used and its data, (None, empty DataFrame) if no resolution covers the location
+        """
+        requested = set()
+        for candidate in RESOLUTIONS:
+            try:
+                url_mg = self._historic_data_day_url(latitude, longitude, day, local_tz, candidate)
+                if url_mg in requested:
+                    continue
+                requested.add(url_mg)
+                return candidate, self._request_historic_data_day(url_mg, local_tz, candidate)
             except Exception as e:
                 logger.error(e)
-        return pd.DataFrame({})
+        return None, pd.DataFrame({})
+
+    def _historic_data_day_url(self, latitude, longitude, day, local_tz, resolution):
+        """
+        Builds the url to get the solar radiation of a location on a given day at a given resolution
+
+        :param latitude: station's latitude
+        :param longitude: station's longitude
+        :param day: day to retrieve data
+        :param local_tz: the timezone of the station
+        :param resolution: tuple with the grid size in km and the domain of the model
+        :return: the url of the csv
+        """
+        run = 0
+        # Last 14 days of operational forecasts
+        # http://mandeo.meteogalicia.es/
+        # thredds/
+        # ncss/
+        # grid/
+        # wrf_2d_04km/
+        # fmrc/
+        # files/
+        # 20180423/
+        # wrf_arw_det_history_d02_20180423_0000.nc4?
+        # var=swflx&
+        # point=true&
+        # accept=csv&
+        # longitude=0.62&
+        # latitude=41.62&
+        # temporal=all
+        if (
+                (pytz.UTC.localize(datetime.datetime.utcnow()).astimezone(local_tz) -
+                 day.astimezone(local_tz)).days <= 14
+        ):
+            url_mg = (
+                "http://mandeo.meteogalicia.es/"
+                "thredds/"
+                "ncss/"
+                "grid/"
+                "wrf_2d_%02ikm/"
+                "fmrc/"
+                "files/"
+                "%s/"
+                "wrf_arw_det_history_d0%s_%s_%02i00.nc4?"
+                "var=swflx&"
+                "point=true&"
+                "accept=csv&"
+                "longitude=%s&"
+                "latitude=%s&"
+                "temporal=all"
+                % (
+                    resolution[0],
+                    datetime.datetime.strftime(day, "%Y%m%d"),
+                    resolution[1],
+                    datetime.datetime.strftime(day, "%Y%m%d"),
+                    run,
+                    longitude,
+                    latitude,
+                )
+            )
+        else:
+            # Historical forecasts. Only run 00 is available
+            # http://mandeo.meteogalicia.es/
+            # thredds/
+            # ncss/
+            # grid/
+            # modelos/
+            # WRF_HIST/
+            # d02/
+            # 2018/
+            # 01/
+            # wrf_arw_det_history_d02_20180122_0000.nc4?
+            # var=swflx&
+            # point=true&
+            # accept=csv&
+            # longitude=41.62&
+            # latitude=0.62&
+            # temporal=all
+            url_mg = (
+                "http://mandeo.meteogalicia.es/"
+                "thredds/"
+                "ncss/"
+                "grid/"
+                "modelos/"
+                "WRF_HIST/"
+                "d0%s"
+                "/%s"
+                "/%s"
+                "/wrf_arw_det_history_d0%s_%s_0000.nc4?"
+                "var=swflx&"
+                "point=true&"
+                "accept=csv&"
+                "longitude=%s&"
+                "latitude=%s&"
+                "temporal=all"
+                % (
+                    resolution[1],
+                    datetime.datetime.strftime(day, "%Y"),
+                    datetime.datetime.strftime(day, "%m"),
+                    resolution[1],
+                    datetime.datetime.strftime(day, "%Y%m%d"),
+                    longitude,
+                    latitude,
+                )
+            )
+        return url_mg
+
+    def _request_historic_data_day(self, url_mg, local_tz, resolution):
+        """
+        Gets solar radiation information from a MeteoGalicia point url
+
+        :param url_mg: url of the csv, see _historic_data_day_url
+        :param local_tz: the timezone to return the timestamp
+        :param resolution: tuple with the grid size in km and the domain of the model
+        :return: all raw data for a given day
+        """
+        r = requests.get(url_mg, timeout=REQUEST_TIMEOUT)
+        solar_data = pd.read_csv(BytesIO(r.content), sep=",")
+        if len(solar_data) == 0:
+            raise Exception(
+                "Location out of the bounding box, "
+                "trying with another resolution..."
+                "(Actual: " + str(resolution) + "km)"
+            )
+        solar_data = solar_data.rename(
+            columns={"date": "time", 'swflx[unit="W m-2"]': "GHI"}
+        )
+        solar_data["ts"] = _pandas_dt_to_ts_utc(
+            _pandas_to_tz(pd.to_datetime(solar_data["time"]), local_tz)
+        )
+        solar_data = solar_data[["ts", "GHI"]]
+        solar_data = solar_data.reset_index(drop=True)
+        return solar_data
 
     def _get_historic_forecasting_raster(self, min_lat, max_lat, min_lon, max_lon, day):
         """
@@ -315,12 +379,18 @@ class MeteoGalicia(Source):
                 )
             )
 
-            r = requests.get(url_mg)
-            with open("temp.nc4", "wb") as temp_file:
-                temp_file.write(r.content)
-
-            nc_data = xr.open_dataset('temp.nc4')
-            df = nc_data.to_dataframe()
+            # stream the netcdf to disk instead of holding the full response in memory, the file is removed
+            # once it has been loaded
+            temp_file = tempfile.NamedTemporaryFile(suffix=".nc4", delete=False)
+            try:
+                with temp_file, requests.get(url_mg, stream=True, timeout=REQUEST_TIMEOUT) as r:
+                    r.raise_for_status()
+                    for chunk in r.iter_content(chunk_size=1 << 20):
+                        temp_file.write(chunk)
+                with xr.open_dataset(temp_file.name) as nc_data:
+                    df = nc_data.to_dataframe()
+            finally:
+                os.unlink(temp_file.name)
 
             names = {
                 "dir": "windSpeed",
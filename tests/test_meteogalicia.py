@@ -1,6 +1,9 @@
 import datetime
+import re
+import time
 
 import pandas as pd
+import pytz
 import json
 from beemeteo.sources.meteogalicia import MeteoGalicia
 
@@ -27,4 +30,95 @@ def test_meteogalicia_forecast():
                                            date_from = datetime.datetime.now()-datetime.timedelta(hours=5), 
                                            date_to = datetime.datetime.now())
     print(forecast)
-    assert forecast.equals(expected)
\ No newline at end of file
+    assert forecast.equals(expected)
+
+def _stub_requests(monkeypatch, covered):
+    requested = []
+
+    def request_historic_data_day(self, url_mg, local_tz, resolution):
+        requested.append(resolution)
+        if resolution not in covered:
+            raise Exception("Location out of the bounding box")
+        return pd.DataFrame({"ts": [0], "GHI": [float(resolution[0])]})
+
+    monkeypatch.setattr(MeteoGalicia, "_request_historic_data_day", request_historic_data_day)
+    return requested
+
+
+def test_meteogalicia_day_finest_resolution(monkeypatch):
+    requested = _stub_requests(monkeypatch, covered=[(12, 1), (36, 2)])
+    source = MeteoGalicia({})
+    day = pytz.UTC.localize(datetime.datetime.utcnow())
+    resolution, data = source._probe_historic_data_day(41.29, 2.19, day, pytz.UTC)
+    assert resolution == (12, 1)
+    assert data.GHI.tolist() == [12.0]
+    assert requested == [(4, 2), (12, 2), (12, 1)]
+
+
+def test_meteogalicia_day_historical_urls_requested_once(monkeypatch):
+    requested = _stub_requests(monkeypatch, covered=[])
+    source = MeteoGalicia({})
+    day = pytz.UTC.localize(datetime.datetime(2023, 9, 16))
+    data = source._get_historic_data_day(41.29, 2.19, day, pytz.UTC)
+    assert data.empty
+    # the historical forecasts only have one url for each model domain
+    assert requested == [(4, 2), (12, 1)]
+
+
+
+def test_meteogalicia_day_url_error(monkeypatch):
+    requested = _stub_requests(monkeypatch, covered=[(4, 2), (12, 2)])
+    historic_data_day_url = MeteoGalicia._historic_data_day_url
+
+    def broken_url(self, latitude, longitude, day, local_tz, resolution):
+        if resolution == (4, 2):
+            raise ValueError("Bad url")
+        return historic_data_day_url(self, latitude, longitude, day, local_tz, resolution)
+
+    monkeypatch.setattr(MeteoGalicia, "_historic_data_day_url", broken_url)
+    source = MeteoGalicia({})
+    day = pytz.UTC.localize(datetime.datetime.utcnow())
+    resolution, _ = source._probe_historic_data_day(41.29, 2.19, day, pytz.UTC)
+    assert resolution == (12, 2)
+    assert requested == [(12, 2)]
+
+def test_meteogalicia_gap_days(monkeypatch):
+    local_tz = pytz.timezone("Europe/Madrid")
+
+    def get_historic_data_day(self, latitude, longitude, day, local_tz):
+        # the 17th has no data, the later days answer first
+        if day.day == 17:
+            return pd.DataFrame({})
+        time.sleep((20 - day.day) / 100)
+        return pd.DataFrame({"ts": [int(day.timestamp()) + 3600 * h for h in range(24)], "GHI": [float(day.day)] * 24})
+
+    monkeypatch.setattr(MeteoGalicia, "_get_historic_data_day", get_historic_data_day)
+    source = MeteoGalicia({})
+    data = source._get_historical_data_source(
+        "41.290", "2.190", [(datetime.datetime(2023, 9, 16), datetime.datetime(2023, 9, 18))], local_tz
+    )
+    assert data.ts.is_monotonic_increasing
+    days = pd.to_datetime(data.ts, unit="s", utc=True).dt.tz_convert(local_tz).dt.day
+    assert sorted(days.unique()) == [16, 18]
+    assert len(data) == 48
+
+
+def test_meteogalicia_gap_transient_failure(monkeypatch):
+    local_tz = pytz.timezone("Europe/Madrid")
+
+    def request_historic_data_day(self, url_mg, local_tz, resolution):
+        day = local_tz.localize(datetime.datetime.strptime(re.search(r"_(\d{8})_0000", url_mg).group(1), "%Y%m%d"))
+        # the finest resolution fails only for the first day of the gap
+        if resolution == (4, 2) and day.day == 16:
+            raise Exception("Timeout")
+        return pd.DataFrame(
+            {"ts": [int(day.timestamp()) + 3600 * h for h in range(24)], "GHI": [float(resolution[0])] * 24}
+        )
+
+    monkeypatch.setattr(MeteoGalicia, "_request_historic_data_day", request_historic_data_day)
+    source = MeteoGalicia({})
+    data = source._get_historical_data_source(
+        "41.290", "2.190", [(datetime.datetime(2023, 9, 16), datetime.datetime(2023, 9, 18))], local_tz
+    )
+    days = pd.to_datetime(data.ts, unit="s", utc=True).dt.tz_convert(local_tz).dt.day
+    assert data.groupby(days.values).GHI.first().to_dict() == {16: 12.0, 17: 4.0, 18: 4.0}